@@ -2,6 +2,8 @@ from    flask import Flask, request, jsonify, send_file
 from    flask_cors import CORS
 from    segment_anything import sam_model_registry, SamAutomaticMaskGenerator
 from    torchvision.transforms import functional as F
+from    torchvision.models.detection.roi_heads import paste_masks_in_image, expand_masks, expand_boxes
+from    torchvision.models.detection.transform import resize_boxes
 from    skimage.measure import label
 from    matplotlib.patches import Patch
 
@@ -30,6 +32,12 @@ CNN_PATH        = "Images/CNN_Img.jpg"
 SAM_I_PATH      = "Images/SAM_I_Img.jpg"
 CNN_I_PATH      = "Images/CNN_I_Img.jpg"
 
+# Mask R-CNN post-processing defaults - can be overridden per request
+CNN_SCORE_THRESH    = 0.7
+CNN_MASK_THRESH     = 0.5
+CNN_LABELS          = None  # None = keep every class
+CNN_PASTE_MASKS     = True  # False = keep masks in box-cropped space
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend requests
 
@@ -53,6 +61,12 @@ def image_processing():
             return jsonify({"error": "No image uploaded"}), 400
         image_file      = request.files["image"]
 
+        # Get Mask R-CNN post-processing options - before anything is saved
+        try:
+            CNN_params  = parse_CNN_params(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         # Save image
         image_file.save(IMAGE_PATH)  
 
@@ -65,7 +79,7 @@ def image_processing():
             json.dump(strokes, f, indent=4)
 
         # Run Image Segmentation in a Separate Thread
-        thread = threading.Thread(target=run_image_segmentation, args=(image_file,))
+        thread = threading.Thread(target=run_image_segmentation, args=(image_file, CNN_params))
         thread.start()
 
         # 202 Accepted: Processing in Progress
@@ -75,14 +89,42 @@ def image_processing():
         PROCESSING_STATUS["status"] = "error"
         return jsonify({"error": str(e)}), 500
 
+# Reads the optional Mask R-CNN post-processing fields of a request
+def parse_CNN_params(form):
+    score_thresh    = float(form.get("cnn_score_thresh", CNN_SCORE_THRESH))
+    mask_thresh     = float(form.get("cnn_mask_thresh", CNN_MASK_THRESH))
+    if not 0.0 <= score_thresh <= 1.0 or not 0.0 <= mask_thresh <= 1.0:
+        raise ValueError("cnn_score_thresh and cnn_mask_thresh must be between 0 and 1")
+
+    # Comma separated COCO label ids, e.g. "1,3"
+    labels_txt      = form.get("cnn_labels", "").strip()
+    labels          = [int(l) for l in labels_txt.split(",") if l.strip()] if labels_txt else CNN_LABELS
+
+    paste_txt       = form.get("cnn_paste", "").strip().lower()
+    if not paste_txt:
+        paste = CNN_PASTE_MASKS
+    elif paste_txt in ("1", "true", "yes"):
+        paste = True
+    elif paste_txt in ("0", "false", "no"):
+        paste = False
+    else:
+        raise ValueError("cnn_paste must be one of 1/true/yes or 0/false/no")
+
+    return {
+        "score_thresh": score_thresh,
+        "mask_thresh":  mask_thresh,
+        "labels":       labels,
+        "paste":        paste,
+    }
+
 # Handles image segmentation
-def run_image_segmentation(image_file):
+def run_image_segmentation(image_file, CNN_params):
     global PROCESSING_STATUS
     try:
         # Step 1: Full image masks detection
-        SAM_masks, CNN_prediction, image = masks_detection()
+        SAM_masks, CNN_detections, image = masks_detection(CNN_params)
         SAM_interpretation(SAM_masks, image)
-        CCN_interpretation(CNN_prediction, image)
+        CCN_interpretation(CNN_detections, image)
         print(f"[INFO] Step 1 - Full image masks detection - complete.")
 
         # Step 2: User-mask processing
@@ -90,7 +132,7 @@ def run_image_segmentation(image_file):
         print(f"[INFO] Step 2 - User mask processing - complete.")
 
         # Step 3: Masks comparing
-        SAM_USER_combined_mask, SAM_combined_mask, CNN_USER_combined_mask, CNN_combined_mask = masks_comparision(user_mask, CNN_prediction, SAM_masks)
+        SAM_USER_combined_mask, SAM_combined_mask, CNN_USER_combined_mask, CNN_combined_mask = masks_comparision(user_mask, CNN_detections, SAM_masks, CNN_params)
         print(f"[INFO] Step 3 - Masks comparing - complete.")
 
         # Step 4: Create visualizations
@@ -110,7 +152,7 @@ def run_image_segmentation(image_file):
         print(f"Error in image processing: {e}")
 
 # Move these to a different py when done
-def masks_detection():
+def masks_detection(CNN_params):
     # Load and prepare an image - BGR to RGB
     image = cv2.imread(IMAGE_PATH)
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
@@ -135,14 +177,78 @@ def masks_detection():
     model           = torchvision.models.detection.maskrcnn_resnet50_fpn(pretrained=True)
     model.eval()
 
+    # Drop low-score boxes inside the ROI heads, before the mask head runs
+    model.roi_heads.score_thresh = CNN_params["score_thresh"]
+
+    # Replace the default postprocess so masks are filtered before pasting
+    model.transform.postprocess = lambda result, image_shapes, original_image_sizes: CNN_postprocess(
+        result, image_shapes, original_image_sizes, CNN_params)
+
     # Inference
     with torch.no_grad():
-        CNN_prediction = model(image_tensor)[0]
+        CNN_detections = model(image_tensor)[0]
 
     # Generate masks
     SAM_masks = mask_generator.generate(image)
-    # CNN_masks = prediction['masks'].cpu().numpy() 
-    return SAM_masks, CNN_prediction, image
+    return SAM_masks, CNN_detections, image
+
+# CNN post-processing - filter, then paste (or crop) and binarize once
+def CNN_postprocess(result, image_shapes, original_image_sizes, CNN_params):
+    detections = []
+    for pred, im_s, o_im_s in zip(result, image_shapes, original_image_sizes):
+        # Score and class filters on the low resolution (28x28) masks
+        keep = pred["scores"] >= CNN_params["score_thresh"]
+        if CNN_params["labels"]:
+            wanted  = torch.tensor(CNN_params["labels"], device=pred["labels"].device)
+            keep    = keep & torch.isin(pred["labels"], wanted)
+        pred = {k: v[keep] for k, v in pred.items()}
+
+        # Boxes back to the original image size
+        boxes           = resize_boxes(pred["boxes"], im_s, o_im_s)
+        img_height      = int(o_im_s[0])
+        img_width       = int(o_im_s[1])
+
+        if CNN_params["paste"]:
+            # Full resolution masks: [N, H, W]
+            masks   = paste_masks_in_image(pred["masks"], boxes, o_im_s)
+            masks   = (masks[:, 0] > CNN_params["mask_thresh"]).cpu().numpy().astype(np.uint8)
+            regions = None
+        else:
+            # Box-cropped masks: same steps as paste_masks_in_image, without the full image canvas
+            padded_masks, scale = expand_masks(pred["masks"], padding=1)
+            padded_boxes        = expand_boxes(boxes, scale).to(dtype=torch.int64)
+            masks               = []
+            regions             = []
+            for box, mask in zip(padded_boxes.tolist(), padded_masks):
+                bx0, by0, bx1, by1  = box
+                w                   = max(bx1 - bx0 + 1, 1)
+                h                   = max(by1 - by0 + 1, 1)
+                mask                = torch.nn.functional.interpolate(mask[None], size=(h, w), mode="bilinear", align_corners=False)[0, 0]
+
+                # Keep only the part of the expanded box inside the image
+                x0, x1  = max(bx0, 0), min(bx1 + 1, img_width)
+                y0, y1  = max(by0, 0), min(by1 + 1, img_height)
+                x1, y1  = max(x1, x0), max(y1, y0)
+                mask    = mask[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0]
+                masks.append((mask > CNN_params["mask_thresh"]).cpu().numpy().astype(np.uint8))
+                regions.append((slice(y0, y1), slice(x0, x1)))
+
+        detections.append({
+            "boxes":        boxes.cpu().numpy(),
+            "labels":       pred["labels"].cpu().numpy(),
+            "scores":       pred["scores"].cpu().numpy(),
+            "masks":        masks,
+            "regions":      regions,
+            "pasted":       CNN_params["paste"],
+        })
+    return detections
+
+# Binary mask of detection i and the image region it covers
+def CNN_mask_region(CNN_detections, i):
+    if CNN_detections["pasted"]:
+        return CNN_detections["masks"][i], (slice(None), slice(None))
+
+    return CNN_detections["masks"][i], CNN_detections["regions"][i]
 
 def show_anns(anns):
     if len(anns) == 0:
@@ -171,25 +277,23 @@ def SAM_interpretation(SAM_masks, image):
     plt.close()
 
 # CNN interpretation
-def CCN_interpretation(CNN_prediction, image):
+def CCN_interpretation(CNN_detections, image):
     visual_image = image.copy()
 
-    # Loop through predictions
-    for i in range(len(CNN_prediction['boxes'])):
-        if CNN_prediction['scores'][i] < 0.7:
-            continue
-
+    # Loop through predictions - already score/class filtered
+    for i in range(len(CNN_detections['boxes'])):
         # Extract bounding box, label, and mask
-        box         = CNN_prediction['boxes'][i].cpu().numpy().astype(int)
-        label_id    = CNN_prediction['labels'][i].item()
-        mask        = (CNN_prediction['masks'][i, 0].cpu().numpy() > 0.5).astype(np.uint8)
+        box             = CNN_detections['boxes'][i].astype(int)
+        label_id        = int(CNN_detections['labels'][i])
+        mask, region    = CNN_mask_region(CNN_detections, i)
 
         # Random color for mask and box
         color = np.random.randint(0, 255, (3,), dtype=int).tolist()
 
-        # Apply colored mask
-        colored_mask = np.stack([mask * c for c in color], axis=-1)
-        visual_image = cv2.addWeighted(visual_image, 1.0, colored_mask, 0.5, 0)
+        # Apply colored mask on the region it covers
+        if mask.size > 0:
+            colored_mask            = np.stack([mask * c for c in color], axis=-1).astype(np.uint8)
+            visual_image[region]    = cv2.addWeighted(visual_image[region], 1.0, colored_mask, 0.5, 0)
 
         # Draw bounding box and label
         cv2.rectangle(visual_image, (box[0], box[1]), (box[2], box[3]), color, 2)
@@ -237,16 +341,26 @@ def compute_iou(mask1, mask2):
     union = np.logical_or(mask1, mask2).sum()
     return intersection / union if union > 0 else 0.0
 
-def compare_masks(USER_binary_masks, AUTO_binary_masks, USER_combined_mask, AUTO_combined_mask):
+# IoU of a full image mask and a mask that only covers region
+def compute_region_iou(full_mask, region_mask, region):
+    intersection = np.logical_and(full_mask[region], region_mask).sum()
+    union = np.count_nonzero(full_mask) + np.count_nonzero(region_mask) - intersection
+    return intersection / union if union > 0 else 0.0
+
+# AUTO_regions: optional image region of each AUTO mask (box-cropped masks)
+def compare_masks(USER_binary_masks, AUTO_binary_masks, USER_combined_mask, AUTO_combined_mask, AUTO_regions=None):
     ious    = []
     for i, u_mask in enumerate(USER_binary_masks):
         best_iou = 0
         best_idx = -1
         for j, b_mask in enumerate(AUTO_binary_masks):
-            if b_mask.shape != u_mask.shape:
-                b_mask = cv2.resize(b_mask, (u_mask.shape[1], u_mask.shape[0]), interpolation=cv2.INTER_NEAREST)
+            if AUTO_regions is not None:
+                iou = compute_region_iou(u_mask, b_mask, AUTO_regions[j])
+            else:
+                if b_mask.shape != u_mask.shape:
+                    b_mask = cv2.resize(b_mask, (u_mask.shape[1], u_mask.shape[0]), interpolation=cv2.INTER_NEAREST)
+                iou = compute_iou(u_mask, b_mask)
 
-            iou = compute_iou(u_mask, b_mask)
             if iou > best_iou:
                 best_iou = iou
                 best_idx = j
@@ -257,30 +371,34 @@ def compare_masks(USER_binary_masks, AUTO_binary_masks, USER_combined_mask, AUTO
 
         best_masks          = AUTO_binary_masks[best_idx]
         USER_combined_mask  = np.logical_or(USER_combined_mask, u_mask)
-        AUTO_combined_mask  = np.logical_or(AUTO_combined_mask, best_masks)
+        if AUTO_regions is not None:
+            region                      = AUTO_regions[best_idx]
+            AUTO_combined_mask          = AUTO_combined_mask.astype(bool)
+            AUTO_combined_mask[region]  = np.logical_or(AUTO_combined_mask[region], best_masks)
+        else:
+            AUTO_combined_mask  = np.logical_or(AUTO_combined_mask, best_masks)
         ious.append(best_iou)
     
     avg_iou = sum(ious) / len(ious) if ious else 0
     return USER_combined_mask, AUTO_combined_mask, avg_iou
 
-def masks_comparision(user_mask, CNN_prediction, SAM_masks):
+def masks_comparision(user_mask, CNN_detections, SAM_masks, CNN_params):
     USER_combined_mask  = np.zeros_like(user_mask)
     user_labeled        = label(user_mask)
     num_regions         = np.max(user_labeled)
     USER_binary_masks   = [(user_labeled == i).astype(np.uint8) for i in range(1, num_regions + 1)]
 
-    score_threshold = 0.7
-    scores = CNN_prediction['scores'].cpu().numpy()
-    keep_indices = np.where(scores >= score_threshold)[0]   
-    CNN_masks = CNN_prediction['masks'][keep_indices].cpu().numpy()[:, 0]
-    CNN_combined_mask = np.zeros_like(user_mask)
-    CNN_binary_masks = (CNN_masks > 0.5).astype(np.uint8)
+    # CNN masks are already filtered and binary - see CNN_postprocess
+    CNN_regions         = [CNN_mask_region(CNN_detections, i) for i in range(len(CNN_detections['boxes']))]
+    CNN_binary_masks    = [mask for mask, _ in CNN_regions]
+    CNN_regions         = [region for _, region in CNN_regions]
+    CNN_combined_mask   = np.zeros_like(user_mask)
 
     SAM_combined_mask   = np.zeros_like(user_mask)
     SAM_binary_masks    = [m["segmentation"].astype(np.uint8) for m in SAM_masks]
 
     SAM_USER_combined_mask, SAM_combined_mask, SAM_avg_iou = compare_masks(USER_binary_masks, SAM_binary_masks, USER_combined_mask, SAM_combined_mask)
-    CNN_USER_combined_mask, CNN_combined_mask, CNN_avg_iou = compare_masks(USER_binary_masks, CNN_binary_masks, USER_combined_mask, CNN_combined_mask)
+    CNN_USER_combined_mask, CNN_combined_mask, CNN_avg_iou = compare_masks(USER_binary_masks, CNN_binary_masks, USER_combined_mask, CNN_combined_mask, CNN_regions)
     SC_iou = compute_iou(SAM_combined_mask, CNN_combined_mask)
 
     # Save to the results to a file
@@ -290,8 +408,12 @@ def masks_comparision(user_mask, CNN_prediction, SAM_masks):
     with open(csv_file, "a", newline="") as f:
         writer = csv.writer(f)
         if write_header:
-            writer.writerow(["SAM_avg_iou", "CNN_avg_iou", "SC_iou"])
-        writer.writerow([SAM_avg_iou, CNN_avg_iou, SC_iou])
+            writer.writerow(["SAM_avg_iou", "CNN_avg_iou", "SC_iou", "score_thresh", "mask_thresh", "labels", "paste"])
+
+        # CNN settings of this run - labels as "1;3", or "all" for every class
+        labels_txt = ";".join(str(l) for l in CNN_params["labels"]) if CNN_params["labels"] else "all"
+        writer.writerow([SAM_avg_iou, CNN_avg_iou, SC_iou,
+                         CNN_params["score_thresh"], CNN_params["mask_thresh"], labels_txt, CNN_params["paste"]])
 
     return SAM_USER_combined_mask, SAM_combined_mask, CNN_USER_combined_mask, CNN_combined_mask
 
@@ -326,7 +448,12 @@ def create_vis(User_combined_mask, Auto_combined_mask, Image_Path, image, label_
     plt.savefig(Image_Path, bbox_inches='tight', pad_inches=0)
 
 def trend_vis():
-    df = pd.read_csv("iou_results.csv")
+    df = pd.read_csv("iou_results.csv", dtype={"labels": str})
+
+    # Only compare runs made with the same CNN settings as the latest one
+    settings    = ["score_thresh", "mask_thresh", "labels", "paste"]
+    last        = df[settings].iloc[-1]
+    df          = df[(df[settings] == last).all(axis=1)].reset_index(drop=True)
 
     # Compute averages
     avg_sam = df["SAM_avg_iou"].mean()